@@ -5,8 +5,10 @@ Returns:
     [str] -- [FreshSales Tap]
 """
 
+import copy
 import os
 import json
+import math
 import sys
 import time
 import backoff
@@ -15,18 +17,62 @@ from requests.exceptions import HTTPError
 import singer
 from singer import utils, metadata
 
-from tap_freshsales import tap_utils
+from tap_freshsales import archive, pipeline, tap_utils
+from tap_freshsales.batch import BatchWriter, DEFAULT_BATCH_SIZE
 
 REQUIRED_CONFIG_KEYS = ["api_key", "domain", "start_date"]
 PER_PAGE = 100
+# Bounds of adaptive page sizes, seconds and bytes a page should stay under
+DEFAULT_PAGE_SIZE_RANGE = [25, 100]
+DEFAULT_TARGET_PAGE_SECONDS = 5
+DEFAULT_MAX_PAGE_BYTES = 5000000
+# Requests allowed per number of seconds
+RATE_LIMIT = 1
+RATE_EVERY = 2
+# Pages queued between fetch and decode, 0 syncs without threads
+DEFAULT_PIPELINE_QUEUE_SIZE = 4
 BASE_URL = "https://{}.freshsales.io"
 CONFIG = {}
 STATE = {}
 LOGGER = singer.get_logger()
 SESSION = requests.Session()
+# Set during sync when records go to batch files instead of stdout
+BATCH_WRITER = None
+# Set during sync when API responses are recorded or replayed
+ARCHIVE = None
+# Requests sent to the API, including those retried after a rate limit
+REQUESTS_MADE = 0
+# Value of REQUESTS_MADE at which listings stop, set during sync
+# from the request_budget share of the stream being synced
+REQUEST_LIMIT = None
+# Listings cut short once REQUEST_LIMIT was reached
+TRUNCATED_LISTINGS = set()
+
+# Streams, deselected fields and schemas from the catalog, set during sync
+SELECTED_STREAMS = []
+DESELECTED_FIELDS = {}
+CATALOG_SCHEMAS = {}
 
 owners = []
 sales_account = []
+FILTERS = {}
+# Side-loaded entities and the stream consuming them, sales accounts
+# side-loaded on contacts are not written out by any stream
+SIDE_LOADS = {
+    "owner": "owners",
+    "sales_account": None,
+}
+# Key holding the rows in the pages of each stream, pages
+# also carry side-loads and meta next to it
+ROW_KEYS = {
+    "leads": "leads",
+    "contacts": "contacts",
+    "accounts": "sales_accounts",
+    "deals": "deals",
+    "tasks": "tasks",
+    "appointments": "appointments",
+    "sales_activities": "sales_activities",
+}
 endpoints = {
     "leads": "/api/leads/{query}",
     "contacts": "/api/contacts/{query}",
@@ -34,33 +80,52 @@ endpoints = {
     "deals": "/api/deals/{query}",
     "tasks": "/api/tasks?filter={filter}&include={include}",
     "appointments": "/api/appointments?filter={filter}&include={include}",
-    "sales_activities": "/api/sales_activities/"
+    "sales_activities": "/api/sales_activities/",
+    "fields": "/api/settings/{entity}/fields"
+}
+# API entity of the streams with custom fields
+CUSTOM_FIELD_ENTITIES = {
+    "contacts": "contacts",
+    "leads": "leads",
+    "accounts": "sales_accounts",
+    "deals": "deals",
 }
+# Schema of FreshSales custom field types, other types are strings
+CUSTOM_FIELD_SCHEMAS = {
+    "number": {"type": ["null", "number"]},
+    "checkbox": {"type": ["null", "boolean"]},
+    "date": {"type": ["null", "string"], "format": "date-time"},
+}
+# Custom field definitions fetched during discovery
+CUSTOM_FIELDS = {}
+# Schemas of the typed custom_field[...] columns per stream, set during sync
+CUSTOM_FIELD_TYPES = {}
 
 
-@tap_utils.ratelimit(1, 2)
+@tap_utils.ratelimit(RATE_LIMIT, RATE_EVERY)
 def request(url, params=None):
     """
     Rate limited API requests to fetch data from
     FreshSales API
     """
-    params = params or {}
-    headers = {}
-    if 'user_agent' in CONFIG:
-        headers['User-Agent'] = CONFIG['user_agent']
-
-    if 'api_key' in CONFIG:
-        headers['Authorization'] = 'Token token=' + CONFIG['api_key']
+    global REQUESTS_MADE
 
-    req = requests.Request('GET', url, params=params,
-                           headers=headers).prepare()
+    req = prepare_request(url, params)
+    bucket = get_bucket_path()
+    if bucket:
+        tap_utils.acquire_token(bucket, *get_shared_rate_limit())
     LOGGER.info("GET {}".format(req.url))
     resp = SESSION.send(req)
+    REQUESTS_MADE += 1
 
     if 'Retry-After' in resp.headers:
         retry_after = int(resp.headers['Retry-After'])
         LOGGER.info(
             "Rate limit reached. Sleeping for {} seconds".format(retry_after))
+        if bucket:
+            # Hold back the other taps on this account as well
+            tap_utils.drain_tokens(bucket, *get_shared_rate_limit(),
+                                   seconds=retry_after)
         time.sleep(retry_after)
         return request(url, params)
 
@@ -69,6 +134,58 @@ def request(url, params=None):
     return resp
 
 
+def get_bucket_path():
+    """
+    Path of the token bucket shared by all taps on the account,
+    None unless shared_rate_limit_dir is configured
+    """
+    if not CONFIG.get('shared_rate_limit_dir'):
+        return None
+    return os.path.join(CONFIG['shared_rate_limit_dir'],
+                        'freshsales-{}.bucket'.format(CONFIG['domain']))
+
+
+def get_shared_rate_limit():
+    """
+    Requests and seconds of the rate limit shared across taps
+    """
+    rate_limit = CONFIG.get('shared_rate_limit', {})
+    return (rate_limit.get('limit', RATE_LIMIT),
+            rate_limit.get('every', RATE_EVERY))
+
+
+def prepare_request(url, params=None):
+    """
+    Prepare an authenticated GET request to the FreshSales API
+    """
+    params = params or {}
+    headers = {}
+    if 'user_agent' in CONFIG:
+        headers['User-Agent'] = CONFIG['user_agent']
+
+    if 'api_key' in CONFIG:
+        headers['Authorization'] = 'Token token=' + CONFIG['api_key']
+
+    return requests.Request('GET', url, params=params,
+                            headers=headers).prepare()
+
+
+def fetch(url, params=None):
+    """
+    Fetch a response from the API, recording it when an archive
+    is recorded, or from the archive without any network access
+    or rate limiting when it is replayed
+    """
+    if ARCHIVE and ARCHIVE.mode == archive.REPLAY:
+        resp = ARCHIVE.replay(prepare_request(url, params))
+        resp.raise_for_status()
+        return resp
+    resp = request(url, params)
+    if ARCHIVE:
+        ARCHIVE.record(resp)
+    return resp
+
+
 def get_url(endpoint, **kwargs):
     """
     Create approprate freshsales URL to create API call to relevant stream
@@ -80,56 +197,136 @@ def get_url(endpoint, **kwargs):
 # Generate request for a given REST API URL
 
 
-def gen_request(url, params=None):
+def gen_request(url, params=None, stream=None):
+    """
+    Generator to yields rows of data for given stream,
+    without the fields deselected for that stream in the catalog
+    """
+    for data in iter_pages(url, params):
+        for row in page_rows(data, stream):
+            yield row
+
+
+def iter_pages(url, params=None, endpoint=None):
     """
-    Generator to yields rows of data for given stream
+    Generator to yield the decoded pages of an API listing,
+    tuning the page size of the endpoint when it is adaptive
     """
-    
+    per_page = get_per_page(endpoint)
     params = params or {}
-    params["per_page"] = PER_PAGE
+    params["per_page"] = per_page
     params["sort"] = 'updated_at'
     params["sort_type"] = 'desc'
     page = 1
+    samples = []
     # TODO: Meta tag carries number of pages
     # Use generator to scan across all pages of output
     while True:
+        if REQUEST_LIMIT is not None and REQUESTS_MADE >= REQUEST_LIMIT:
+            LOGGER.warning(
+                "Request budget used up, stopping {} at page {}".format(
+                    url, page))
+            TRUNCATED_LISTINGS.add(url)
+            break
         params['page'] = page
-        data = request(url, params).json()
-        data_list = []
-        if type(data) == type({}):
-            # TODO: Most API endpoint results the first key is data
-
-            first_key = list(data.keys())[0]
-            if first_key == 'filters':
-                yield data
-            elif first_key == 'meta':
-                if 'contacts' in data.keys():
-                    for row in data['contacts']:
-                        yield row
-                else:
-                    break
-            elif first_key == 'sales_accounts':
-                if 'contacts' in data.keys():
-                    for row in data['contacts']:
-                        yield row
-                else:
-                    break
-            else:
-                data_list = data[first_key]
-                if "users" in data.keys():
-                    try:
-                        owners.append(
-                            data['users'][0])  # there is only one user per item
-                    except:
-                        LOGGER.info("item with no owner")
-                    data.pop('users')
-                    first_key = list(data.keys())[0]
-                for row in data[first_key]:
-                    yield row
-            if len(data_list) == PER_PAGE:
-                page += 1
-            else:
-                break
+        resp = fetch(url, params)
+        data = resp.json()
+        if type(data) != type({}):
+            break
+        next_page = page_length(data, endpoint) == per_page
+        # The short last page says nothing about the page size
+        if next_page:
+            samples.append(page_sample(resp))
+        yield data
+        if next_page:
+            page += 1
+        else:
+            break
+    if endpoint and CONFIG.get('adaptive_page_size') and samples:
+        tune_per_page(endpoint, per_page, samples)
+
+
+def get_per_page(endpoint):
+    """
+    Page size of an endpoint, as tuned by previous listings
+    when adaptive_page_size is configured
+    """
+    if not endpoint or not CONFIG.get('adaptive_page_size'):
+        return PER_PAGE
+    low, high = CONFIG.get('page_size_range', DEFAULT_PAGE_SIZE_RANGE)
+    per_page = STATE.get('per_page', {}).get(endpoint, PER_PAGE)
+    return max(low, min(high, per_page))
+
+
+def page_sample(resp):
+    """
+    Seconds, bytes and rate limit headroom of a fetched page
+    """
+    headroom = 1.0
+    if 'X-RateLimit-Remaining' in resp.headers and \
+            'X-RateLimit-Limit' in resp.headers:
+        headroom = int(resp.headers['X-RateLimit-Remaining']) / \
+            float(resp.headers['X-RateLimit-Limit'])
+    return resp.elapsed.total_seconds(), len(resp.content), headroom
+
+
+def tune_per_page(endpoint, per_page, samples):
+    """
+    Tune the page size of an endpoint for its next listing from the
+    samples of the full pages of a listing. Halve it when the slowest
+    or largest page was over target, double it when all pages took
+    well under target or the rate limit ran low
+    """
+    low, high = CONFIG.get('page_size_range', DEFAULT_PAGE_SIZE_RANGE)
+    target_seconds = CONFIG.get('target_page_seconds',
+                                DEFAULT_TARGET_PAGE_SECONDS)
+    max_bytes = CONFIG.get('max_page_bytes', DEFAULT_MAX_PAGE_BYTES)
+    seconds = max(sample[0] for sample in samples)
+    size = max(sample[1] for sample in samples)
+    headroom = min(sample[2] for sample in samples)
+
+    if seconds > target_seconds or size > max_bytes:
+        tuned = per_page // 2
+    elif (seconds < target_seconds / 2 and size < max_bytes / 2) or \
+            headroom < 0.2:
+        tuned = per_page * 2
+    else:
+        tuned = per_page
+    tuned = max(low, min(high, tuned))
+    # Replace rather than update the sizes, state may be written
+    # out on another thread while pages are fetched
+    per_page_state = dict(STATE.get('per_page', {}))
+    per_page_state[endpoint] = tuned
+    STATE['per_page'] = per_page_state
+
+
+def page_length(data, stream=None):
+    """
+    Number of rows in a decoded page of a stream, listings
+    outside the streams, such as filters, are not paginated
+    """
+    if stream not in ROW_KEYS:
+        return 0
+    return len(data.get(ROW_KEYS[stream], []))
+
+
+def page_rows(data, stream=None):
+    """
+    Generator to yield the rows of a decoded page, collecting
+    side-loaded owners on the way. Pages of listings outside the
+    streams, such as filters, are yielded whole
+    """
+    if stream not in ROW_KEYS:
+        yield data
+        return
+    if "users" in data.keys():
+        try:
+            owners.append(select_fields(
+                'owners', data['users'][0]))  # there is only one user per item
+        except:
+            LOGGER.info("item with no owner")
+    for row in data.get(ROW_KEYS[stream], []):
+        yield select_fields(stream, row)
 
 
 def load_schemas():
@@ -157,6 +354,13 @@ def discover():
 
     for schema_name, schema in raw_schemas.items():
 
+        if CONFIG.get('typed_custom_fields') and \
+                schema_name in CUSTOM_FIELD_ENTITIES:
+            for field in get_custom_fields(schema_name):
+                schema['properties']['custom_field[{}]'.format(
+                    field['name'])] = copy.deepcopy(CUSTOM_FIELD_SCHEMAS.get(
+                        field['type'], {"type": ["null", "string"]}))
+
         # Default metadata templated on
         # https://github.com/singer-io/getting-started/blob/master/docs/DISCOVERY_MODE.md
         default_meta = {
@@ -185,6 +389,16 @@ def discover():
         }
 
         stream_metadata = [default_meta, id_meta, bookmark_meta]
+        # Every other field can be deselected to prune it from the output
+        for prop in schema['properties']:
+            if prop not in ('id', 'updated_at'):
+                stream_metadata.append({
+                    "metadata": {
+                        "inclusion": "available",
+                        "selected-by-default": True,
+                    },
+                    "breadcrumb": ["properties", prop]
+                })
         stream_key_properties = []
 
         # create and add catalog entry
@@ -200,6 +414,64 @@ def discover():
     return {'streams': streams}
 
 
+def get_custom_fields(endpoint):
+    """
+    Custom field definitions of a stream, fetched from
+    the FreshSales field settings once per run
+    """
+    if endpoint not in CUSTOM_FIELDS:
+        url = get_url('fields', entity=CUSTOM_FIELD_ENTITIES[endpoint])
+        fields = fetch(url).json().get('fields', [])
+        CUSTOM_FIELDS[endpoint] = [field for field in fields
+                                   if field['name'].startswith('cf_')]
+    return CUSTOM_FIELDS[endpoint]
+
+
+def cast_custom_field(value, schema):
+    """
+    Cast a custom field value to the type of its column
+    """
+    if value is None or value == '':
+        return None
+    types = schema.get('type', [])
+    if 'boolean' in types:
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() in ('true', '1', 'yes')
+    if 'number' in types:
+        try:
+            return float(value)
+        except ValueError:
+            LOGGER.warning("Custom field value {} is not a number".format(value))
+            return None
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    value = str(value)
+    # Date fields hold dates without a time
+    if schema.get('format') == 'date-time' and len(value) == 10:
+        value += 'T00:00:00Z'
+    return value
+
+
+def flatten_custom_fields(endpoint, record):
+    """
+    Move the custom fields of a record into the typed custom_field[...]
+    columns of its schema, dropping those without a column
+    """
+    if endpoint not in CUSTOM_FIELD_TYPES:
+        CUSTOM_FIELD_TYPES[endpoint] = {
+            prop: prop_schema for prop, prop_schema
+            in get_schema(endpoint)['properties'].items()
+            if prop.startswith('custom_field[')}
+    types = CUSTOM_FIELD_TYPES[endpoint]
+    custom_fields = record.pop('custom_field', None) or {}
+    for name, value in custom_fields.items():
+        prop = 'custom_field[{}]'.format(name)
+        if prop in types:
+            record[prop] = cast_custom_field(value, types[prop])
+    return record
+
+
 def get_selected_streams(catalog):
     """
     Gets selected streams.  Checks schema's 'selected' first (legacy)
@@ -217,14 +489,76 @@ def get_selected_streams(catalog):
     return selected_streams
 
 
+def get_deselected_fields(catalog):
+    """
+    Gets the fields of each stream which are not selected in the
+    catalog metadata, fields without a 'selected' entry fall back on
+    'selected-by-default' and are kept when neither is present
+    """
+    deselected_fields = {}
+    for stream in catalog['streams']:
+        stream_metadata = metadata.to_map(stream['metadata'])
+        fields = set()
+        for breadcrumb, field_meta in stream_metadata.items():
+            if len(breadcrumb) != 2 or \
+                    field_meta.get('inclusion') == 'automatic':
+                continue
+            selected = field_meta.get(
+                'selected', field_meta.get('selected-by-default', True))
+            if not selected or field_meta.get('inclusion') == 'unsupported':
+                fields.add(breadcrumb[1])
+        if fields:
+            deselected_fields[stream['tap_stream_id']] = fields
+
+    return deselected_fields
+
+
+def select_fields(stream, row):
+    """
+    Drop the fields deselected for a stream from a row
+    """
+    for field in DESELECTED_FIELDS.get(stream, ()):
+        row.pop(field, None)
+    return row
+
+
+def get_schema(endpoint):
+    """
+    Load the schema of a stream from the catalog, or from the schemas
+    folder when syncing without one, trimmed to its selected fields
+    """
+    if endpoint in CATALOG_SCHEMAS:
+        schema = copy.deepcopy(CATALOG_SCHEMAS[endpoint])
+    else:
+        schema = tap_utils.load_schema(endpoint)
+    for field in DESELECTED_FIELDS.get(endpoint, ()):
+        schema['properties'].pop(field, None)
+    return schema
+
+
+def get_view_query(fil_id, includes):
+    """
+    Build the query for a view, side-loading only the includes
+    whose consuming stream is selected
+    """
+    query = 'view/' + str(fil_id)
+    includes = [inc for inc in includes
+                if SIDE_LOADS[inc] in SELECTED_STREAMS]
+    if includes:
+        query += '?include=' + ','.join(includes)
+    return query
+
+
 def get_filters(endpoint):
     """
     Use Freshsales API structure to derive filters for an
     endpoint in the supported streams
     """
-    url = get_url(endpoint, query='filters')
-    filters = list(gen_request(url))[0]['filters']
-    return filters
+    # Filters are cached as the sync plan already fetched them
+    if endpoint not in FILTERS:
+        url = get_url(endpoint, query='filters')
+        FILTERS[endpoint] = list(gen_request(url))[0]['filters']
+    return FILTERS[endpoint]
 
 
 def get_start(entity):
@@ -238,6 +572,69 @@ def get_start(entity):
     return STATE[entity]
 
 
+def write_record(stream, record):
+    """
+    Emit a record as a RECORD message, or into the batch files
+    of the stream when batch output is configured
+    """
+    if BATCH_WRITER:
+        BATCH_WRITER.write(stream, record)
+    else:
+        singer.write_record(stream, record,
+                            time_extracted=singer.utils.now())
+
+
+def write_state():
+    """
+    Emit current state, in batch mode once the file holding the
+    records covered by that state is closed
+    """
+    if BATCH_WRITER:
+        BATCH_WRITER.set_state(copy.deepcopy(STATE))
+    else:
+        singer.write_state(STATE)
+
+
+def flush_batches():
+    """
+    Close the open batch files and emit the state held back for them,
+    called once a view or stream is done
+    """
+    if BATCH_WRITER:
+        BATCH_WRITER.flush()
+
+
+def sync_stream(stream, url, transform, emit):
+    """Fetch, decode, transform and emit every row of an API listing,
+    as pipelined stages unless pipeline_queue_size is set to 0.
+    Returns False when the listing was cut short by the request budget
+
+    Arguments:
+        stream {[str]} -- [Stream whose fields are selected in the catalog]
+        url {[str]} -- [API listing to page through]
+        transform {[function]} -- [Maps a row to an iterable of records to emit]
+        emit {[function]} -- [Writes out a single record]
+    """
+    stages = [
+        ('decode', lambda data: page_rows(data, stream)),
+        ('transform', transform),
+    ]
+    queue_size = int(CONFIG.get('pipeline_queue_size',
+                                DEFAULT_PIPELINE_QUEUE_SIZE))
+    if queue_size <= 0:
+        pipeline.run_serial(iter_pages(url, endpoint=stream), stages, emit)
+    else:
+        # Pages are queued for decode, rows for transform and emit
+        stats = pipeline.run_pipeline(
+            iter_pages(url, endpoint=stream), stages, emit,
+            [queue_size, queue_size * get_per_page(stream),
+             queue_size * get_per_page(stream)])
+        LOGGER.info("Pipeline stats for {} {}: {}".format(
+            stream, url, json.dumps(stats)))
+    flush_batches()
+    return url not in TRUNCATED_LISTINGS
+
+
 # TODO: This is very WET code , clean it up with streams mechanism
 # Sync accounts
 
@@ -249,7 +646,7 @@ def sync_accounts():
     """
     bookmark_property = 'updated_at'
     endpoint = 'accounts'
-    schema = tap_utils.load_schema(endpoint)
+    schema = get_schema(endpoint)
     singer.write_schema(endpoint,
                         schema, ["id"],
                         bookmark_properties=[bookmark_property])
@@ -270,15 +667,19 @@ def sync_accounts_by_filter(bookmark_prop, fil):
     fil_id = fil['id']
     state_entity = endpoint + "_" + str(fil_id)
     start = get_start(state_entity)
-    accounts = gen_request(
-        get_url(endpoint, query='view/' + str(fil_id) + '?include=owner'))
-    for acc in accounts:
+
+    def transform(acc):
         if acc[bookmark_prop] >= start:
             LOGGER.info("Account {}: Syncing details".format(acc['id']))
-            acc['custom_field'] = json.dumps(acc['custom_field'])
-            singer.write_record("accounts",
-                                acc,
-                                time_extracted=singer.utils.now())
+            if CONFIG.get('typed_custom_fields'):
+                flatten_custom_fields(endpoint, acc)
+            elif 'custom_field' in acc:
+                acc['custom_field'] = json.dumps(acc['custom_field'])
+            yield acc
+
+    sync_stream(endpoint,
+                get_url(endpoint, query=get_view_query(fil_id, ['owner'])),
+                transform, lambda acc: write_record("accounts", acc))
 
 
 def sync_contacts():
@@ -289,7 +690,7 @@ def sync_contacts():
     """
     bookmark_property = 'updated_at'
     endpoint = 'contacts'
-    schema = tap_utils.load_schema(endpoint)
+    schema = get_schema(endpoint)
     singer.write_schema(endpoint,
                         schema, ["id"],
                         bookmark_properties=[bookmark_property])
@@ -309,16 +710,28 @@ def sync_contacts_by_filter(bookmark_prop, fil):
     fil_id = fil['id']
     state_entity = endpoint + "_" + str(fil_id)
     start = get_start(state_entity)
-    contacts = gen_request(
-        get_url(endpoint, query='view/' + str(fil_id) + '?include=owner,sales_account'))
-    for con in contacts:
+
+    def transform(con):
         if con[bookmark_prop] >= start:
             LOGGER.info("Contact {}: Syncing details".format(con['id']))
-            tap_utils.update_state(STATE, state_entity, con[bookmark_prop])
-            singer.write_record(endpoint,
-                                con,
-                                time_extracted=singer.utils.now())
-            singer.write_state(STATE)
+            if CONFIG.get('typed_custom_fields'):
+                flatten_custom_fields(endpoint, con)
+            yield con
+
+    def emit(con):
+        tap_utils.update_state(STATE, state_entity, con[bookmark_prop])
+        write_record(endpoint, con)
+        write_state()
+
+    complete = sync_stream(endpoint,
+                           get_url(endpoint, query=get_view_query(
+                               fil_id, ['owner', 'sales_account'])),
+                           transform, emit)
+    if not complete:
+        # Rows come newest first, keep the bookmark so the
+        # older rows left out are synced next time
+        STATE[state_entity] = start
+        write_state()
 
 
 # Batch sync deals and stages of deals
@@ -331,7 +744,7 @@ def sync_deals():
     bookmark_property = 'updated_at'
     endpoint = 'deals'
     singer.write_schema(endpoint,
-                        tap_utils.load_schema(endpoint), ["id"],
+                        get_schema(endpoint), ["id"],
                         bookmark_properties=[bookmark_property])
     filters = get_filters(endpoint)
     for fil in filters:
@@ -349,18 +762,23 @@ def sync_deals_by_filter(bookmark_prop, fil):
     fil_id = fil['id']
     state_entity = endpoint + "_" + str(fil_id)
     start = get_start(state_entity)
-    deals = gen_request(
-        get_url(endpoint, query='view/' + str(fil_id) + '?include=owner'))
-    for deal in deals:
+
+    def transform(deal):
         if deal[bookmark_prop] >= start:
             # get all sub-entities and save them
-            deal['amount'] = float(deal['amount'])  # cast amount to float
-            deal['custom_field'] = json.dumps(
-                deal['custom_field'])  # Make JSON String to store
+            if 'amount' in deal:
+                deal['amount'] = float(deal['amount'])  # cast amount to float
+            if CONFIG.get('typed_custom_fields'):
+                flatten_custom_fields(endpoint, deal)
+            elif 'custom_field' in deal:
+                deal['custom_field'] = json.dumps(
+                    deal['custom_field'])  # Make JSON String to store
             LOGGER.info("Deal {}: Syncing details".format(deal['id']))
-            singer.write_record("deals",
-                                deal,
-                                time_extracted=singer.utils.now())
+            yield deal
+
+    sync_stream(endpoint,
+                get_url(endpoint, query=get_view_query(fil_id, ['owner'])),
+                transform, lambda deal: write_record("deals", deal))
 
 
 # Sync leads across all filters
@@ -373,7 +791,7 @@ def sync_leads():
     bookmark_property = 'updated_at'
     endpoint = 'leads'
     singer.write_schema(endpoint,
-                        tap_utils.load_schema(endpoint), ["id"],
+                        get_schema(endpoint), ["id"],
                         bookmark_properties=[bookmark_property])
     filters = get_filters(endpoint)
     for fil in filters:
@@ -392,14 +810,17 @@ def sync_leads_by_filter(bookmark_prop, fil):
     fil_id = fil['id']
     state_entity = endpoint + "_" + str(fil_id)
     start = get_start(state_entity)
-    leads = gen_request(
-        get_url(endpoint, query='view/' + str(fil_id) + '?include=owner'))
-    for lead in leads:
+
+    def transform(lead):
         if lead[bookmark_prop] >= start:
             LOGGER.info("Lead {}: Syncing details".format(lead['id']))
-            singer.write_record("leads",
-                                lead,
-                                time_extracted=singer.utils.now())
+            if CONFIG.get('typed_custom_fields'):
+                flatten_custom_fields(endpoint, lead)
+            yield lead
+
+    sync_stream(endpoint,
+                get_url(endpoint, query=get_view_query(fil_id, ['owner'])),
+                transform, lambda lead: write_record("leads", lead))
 
 
 # Fetch tasks stream
@@ -412,7 +833,7 @@ def sync_tasks():
     endpoint = 'tasks'
     bookmark_property = 'updated_at'
     singer.write_schema(endpoint,
-                        tap_utils.load_schema(endpoint), ["id"],
+                        get_schema(endpoint), ["id"],
                         bookmark_properties=[bookmark_property])
     # Hardcoded task filters
     filters = ['open', 'due today', 'due tomorrow', 'overdue', 'completed']
@@ -431,11 +852,15 @@ def sync_tasks_by_filter(bookmark_prop, fil):
     state_entity = endpoint + "_" + str(fil)
     # TODO: Verify updated-at exists for tasks
     #start = get_start(state_entity)
-    tasks = gen_request(
-        get_url(endpoint, filter=fil, include='owner,users,targetable'))
-    for task in tasks:
+
+    def transform(task):
         LOGGER.info("Task {}: Syncing details".format(task['id']))
-        singer.write_record(endpoint, task, time_extracted=singer.utils.now())
+        yield task
+
+    sync_stream(endpoint,
+                get_url(endpoint, filter=fil,
+                        include='owner,users,targetable'),
+                transform, lambda task: write_record(endpoint, task))
 
 
 # Fetch sales_activities stream
@@ -448,15 +873,16 @@ def sync_sales_activities():
     state_entity = endpoint
     start = get_start(state_entity)
     singer.write_schema(endpoint,
-                        tap_utils.load_schema(endpoint), ["id"],
+                        get_schema(endpoint), ["id"],
                         bookmark_properties=[bookmark_property])
-    sales = gen_request(get_url(endpoint))
-    for sale in sales:
+
+    def transform(sale):
         if sale[bookmark_property] >= start:
             LOGGER.info("Sale {}: Syncing details".format(sale['id']))
-            singer.write_record("sale_activities",
-                                sale,
-                                time_extracted=singer.utils.now())
+            yield sale
+
+    sync_stream(endpoint, get_url(endpoint), transform,
+                lambda sale: write_record("sale_activities", sale))
 
 
 # Fetch all team appointments
@@ -470,7 +896,7 @@ def sync_appointments():
     bookmark_property = 'updated_at'
     filters = ['past', 'upcoming']
     singer.write_schema(endpoint,
-                        tap_utils.load_schema(endpoint), ["id"],
+                        get_schema(endpoint), ["id"],
                         bookmark_properties=[bookmark_property])
     for fil in filters:
         sync_appointments_by_filter(bookmark_property, fil)
@@ -490,15 +916,16 @@ def sync_appointments_by_filter(bookmark_property, fil):
     endpoint = 'appointments'
     # TODO: Verify updated_at exists for appointments
     #start = get_start(endpoint)
-    appts = gen_request(
-        get_url(endpoint,
-                filter=fil,
-                include='creater,targetable,appointment_attendees'))
-    for appoint in appts:
+
+    def transform(appoint):
         LOGGER.info("Appointment {}: Syncing details".format(appoint['id']))
-        singer.write_record(endpoint,
-                            appoint,
-                            time_extracted=singer.utils.now())
+        yield appoint
+
+    sync_stream(endpoint,
+                get_url(endpoint,
+                        filter=fil,
+                        include='creater,targetable,appointment_attendees'),
+                transform, lambda appoint: write_record(endpoint, appoint))
 
 
 def sync_owners_all():
@@ -508,7 +935,7 @@ def sync_owners_all():
     """
     bookmark_property = 'id'
     endpoint = 'owners'
-    schema = tap_utils.load_schema('owners')
+    schema = get_schema(endpoint)
     singer.write_schema(endpoint,
                         schema, ["id"],
                         bookmark_properties=[bookmark_property])
@@ -516,11 +943,99 @@ def sync_owners_all():
         state_entity = "owner" + "_" + str(owner['id'])
         if state_entity not in STATE:
             LOGGER.info("Owner {}: Syncing details".format(owner['id']))
-            singer.write_record("owners",
-                                owner,
-                                time_extracted=singer.utils.now())
+            write_record("owners", owner)
             tap_utils.update_state(STATE, state_entity, owner['id'])
-            singer.write_state(STATE)
+            write_state()
+    flush_batches()
+
+
+# Sync function of each stream, in the default sync order. Owners are
+# side-loaded by the other streams and have to be synced last
+STREAM_SYNCS = [
+    ('contacts', sync_contacts),
+    ('appointments', sync_appointments),
+    ('deals', sync_deals),
+    # ('sales_activities', sync_sales_activities),
+    ('leads', sync_leads),
+    ('accounts', sync_accounts),
+    # ('tasks', sync_tasks),
+    ('owners', sync_owners_all),
+]
+
+
+def estimate_pages(url, endpoint):
+    """
+    Probe an API listing with a single row page and use
+    the totals in its meta to estimate the pages of a full sync
+    """
+    data = fetch(url, {'per_page': 1, 'page': 1}).json()
+    meta = data.get('meta', {}) if type(data) == type({}) else {}
+    # With one row per page total_pages is the number of rows
+    total = meta.get('total', meta.get('total_pages'))
+    if total is None:
+        return 1
+    return max(1, int(math.ceil(total / float(get_per_page(endpoint)))))
+
+
+def estimate_stream(endpoint):
+    """
+    Estimate the pages requested for every view of a stream
+    """
+    if endpoint == 'owners':
+        return {}
+    if endpoint == 'appointments':
+        return {fil: estimate_pages(
+            get_url(endpoint, filter=fil, include=''), endpoint)
+            for fil in ['past', 'upcoming']}
+    return {str(fil['id']): estimate_pages(
+        get_url(endpoint, query='view/' + str(fil['id'])), endpoint)
+        for fil in get_filters(endpoint)}
+
+
+def plan_sync(config, selected_streams):
+    """Probe the selected streams and schedule them by priority
+    within the request budget
+
+    Streams are planned in order of descending priority, each is
+    allotted its estimated requests out of what is left of the budget
+    after the probes, or whatever is left when they do not fit. Streams
+    allotted nothing are not scheduled
+
+    Arguments:
+        config {[dict]} -- [Holds request_budget and stream_priorities]
+        selected_streams {[list]} -- [Streams selected in the catalog]
+    """
+    priorities = config.get('stream_priorities', {})
+    budget = config.get('request_budget')
+    streams = [stream for stream, _ in STREAM_SYNCS
+               if stream in selected_streams]
+    streams.sort(key=lambda stream: (stream == 'owners',
+                                     -priorities.get(stream, 0)))
+
+    probes_before = REQUESTS_MADE
+    plan = []
+    for stream in streams:
+        views = estimate_stream(stream)
+        plan.append({
+            'stream': stream,
+            'priority': priorities.get(stream, 0),
+            'views': views,
+            'estimated_requests': sum(views.values()),
+        })
+
+    remaining = None
+    if budget is not None:
+        remaining = budget - (REQUESTS_MADE - probes_before)
+    for entry in plan:
+        allotted = entry['estimated_requests']
+        if remaining is not None:
+            allotted = max(0, min(allotted, remaining))
+            remaining -= allotted
+        entry['allotted_requests'] = allotted
+        # Owners are side-loaded and need no requests of their own
+        entry['scheduled'] = allotted > 0 or \
+            entry['estimated_requests'] == 0
+    return plan
 
 
 def sync(config, state, catalog):
@@ -532,40 +1047,73 @@ def sync(config, state, catalog):
         catalog {[str]} -- [All streams catalog string (JSON formatted)]
     """
 
+    global ARCHIVE, BATCH_WRITER, SELECTED_STREAMS, DESELECTED_FIELDS
+    global CATALOG_SCHEMAS, CUSTOM_FIELD_TYPES, REQUEST_LIMIT
+
     LOGGER.info("Starting FreshSales sync")
     STATE.update(state)
+    if config.get('batch_output_dir'):
+        BATCH_WRITER = BatchWriter(
+            config['batch_output_dir'],
+            int(config.get('batch_size', DEFAULT_BATCH_SIZE)))
+    if config.get('archive_path'):
+        ARCHIVE = archive.ResponseArchive(
+            config['archive_path'], config.get('archive_mode', archive.RECORD))
     # Synchronize x7 data-streams
-    # TODO: Use selected streams only
-    # TODO: Use map based function compresenion to link fetch
-    # function and stream name
 
     selected_streams = get_selected_streams(catalog)
+    SELECTED_STREAMS = selected_streams
+    DESELECTED_FIELDS = get_deselected_fields(catalog)
+    CATALOG_SCHEMAS = {stream['tap_stream_id']: stream['schema']
+                       for stream in catalog['streams']}
+    CUSTOM_FIELD_TYPES = {}
     try:
-        
-        if 'contacts' in selected_streams:
-            sync_contacts()
-        if 'appointments' in selected_streams:
-            sync_appointments()
-        if 'deals' in selected_streams:
-            sync_deals()
-        # if 'sales_activities' in selected_streams:
-        #    sync_sales_activities()
-        if 'leads' in selected_streams:
-            sync_leads()
-        if 'accounts' in selected_streams:
-            sync_accounts()
-        # if 'tasks' in selected_streams:
-        #    sync_tasks()
-        if 'owners' in selected_streams:
-            sync_owners_all()
+        plan = [{'stream': stream, 'allotted_requests': None}
+                for stream, _ in STREAM_SYNCS if stream in selected_streams]
+        budget = config.get('request_budget')
+        budget_start = REQUESTS_MADE
+        if budget is not None or config.get('stream_priorities') or \
+                config.get('dry_run'):
+            plan = plan_sync(config, selected_streams)
+            LOGGER.info("Sync plan: {}".format(json.dumps(plan, indent=2)))
+            if config.get('dry_run'):
+                LOGGER.info("Dry run, skipping sync")
+                return
+            for entry in plan:
+                if not entry['scheduled']:
+                    LOGGER.warning(
+                        "Skipping {}: {} requests do not fit the budget".format(
+                            entry['stream'], entry['estimated_requests']))
+                elif entry['allotted_requests'] < entry['estimated_requests']:
+                    LOGGER.warning(
+                        "Partially syncing {}: {} of {} requests fit the "
+                        "budget".format(entry['stream'],
+                                        entry['allotted_requests'],
+                                        entry['estimated_requests']))
+            plan = [entry for entry in plan if entry['scheduled']]
+        sync_functions = dict(STREAM_SYNCS)
+        for index, entry in enumerate(plan):
+            if budget is not None:
+                # Keep the shares of the streams still to come, a stream
+                # may use what earlier ones left unspent
+                REQUEST_LIMIT = budget_start + budget - sum(
+                    later['allotted_requests'] for later in plan[index + 1:])
+            sync_functions[entry['stream']]()
 
     except HTTPError as e:
         LOGGER.critical(
             "Error making request to FreshSales API: GET %s: [%s - %s]",
             e.request.url, e.response.status_code, e.response.content)
         sys.exit(1)
+    finally:
+        REQUEST_LIMIT = None
+        if ARCHIVE:
+            ARCHIVE.close()
+            ARCHIVE = None
 
-    LOGGER.info("Completed sync")
+    write_state()
+    flush_batches()
+    LOGGER.info("Completed sync with {} requests".format(REQUESTS_MADE))
 
 
 @utils.handle_top_exception(LOGGER)
@@ -584,7 +1132,7 @@ def main():
     # Otherwise run in sync mode
     else:
         if args.catalog:
-            catalog = args.catalog
+            catalog = args.catalog.to_dict()
         else:
             catalog = discover()
 
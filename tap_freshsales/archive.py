@@ -0,0 +1,73 @@
+"""Archive of FreshSales API responses
+
+Responses are stored zlib compressed in a SQLite file indexed on the
+request URL, so a sync can be recorded once and replayed offline.
+"""
+
+import json
+import sqlite3
+import threading
+import zlib
+
+import requests
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class ResponseArchive(object):
+    """Record responses to, or replay them from, an archive file
+    """
+
+    def __init__(self, path, mode):
+        if mode not in (RECORD, REPLAY):
+            raise Exception(
+                "Archive mode must be '{}' or '{}', got '{}'".format(
+                    RECORD, REPLAY, mode))
+        self.mode = mode
+        self.lock = threading.Lock()
+        # Pages are fetched on pipeline threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, status INTEGER, "
+            "headers TEXT, content BLOB)")
+        self.connection.commit()
+
+    def record(self, resp):
+        """
+        Store a response under the URL it was requested with
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (resp.request.url, resp.status_code,
+                 json.dumps(dict(resp.headers)),
+                 zlib.compress(resp.content)))
+            self.connection.commit()
+
+    def replay(self, req):
+        """
+        Rebuild the response stored for a prepared request,
+        a 404 response when the request was never recorded
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, headers, content FROM responses "
+                "WHERE url = ?", (req.url,)).fetchone()
+        resp = requests.Response()
+        resp.url = req.url
+        resp.request = req
+        if row is None:
+            resp.status_code = 404
+            resp.reason = 'Not in archive'
+            resp._content = b''
+            return resp
+        resp.status_code = row[0]
+        resp.headers.update(json.loads(row[1]))
+        resp._content = zlib.decompress(row[2])
+        return resp
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,126 @@
+"""Batch output for large syncs
+
+Records are written to rotated, gzip compressed JSONL files per stream
+and announced on stdout with BATCH messages, so targets that can bulk
+load files do not have to consume one RECORD message per row.
+"""
+
+import datetime
+import gzip
+import json
+import os
+
+import singer
+
+from tap_freshsales import tap_utils
+
+DEFAULT_BATCH_SIZE = 100000
+
+
+class BatchMessage(singer.Message):
+    """BATCH message pointing at one or more files of records
+    for a stream
+    """
+
+    def __init__(self, stream, manifest, encoding=None):
+        self.stream = stream
+        self.manifest = manifest
+        self.encoding = encoding or {"format": "jsonl",
+                                     "compression": "gzip"}
+
+    def asdict(self):
+        return {
+            "type": "BATCH",
+            "stream": self.stream,
+            "encoding": self.encoding,
+            "manifest": self.manifest,
+        }
+
+
+class BatchWriter(object):
+    """Write records of each stream into rotated, compressed files
+
+    A file is closed once it holds batch_size records or when the
+    writer is flushed. Every closed file gets a manifest next to it
+    and a BATCH message on stdout, followed by the last state handed
+    to the writer before the file was closed.
+    """
+
+    def __init__(self, directory, batch_size=DEFAULT_BATCH_SIZE):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.open_files = {}
+        self.sequence = {}
+        self.state = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def set_state(self, state):
+        """
+        Hold back a state until the files with the records
+        it covers are announced
+        """
+        self.state = state
+
+    def write(self, stream, record):
+        """
+        Append a record to the current file of the stream,
+        rotating the file when it is full
+        """
+        if stream not in self.open_files:
+            self._open(stream)
+        batch = self.open_files[stream]
+        batch['file'].write(json.dumps(record) + '\n')
+        batch['records'] += 1
+        if batch['records'] >= self.batch_size:
+            self.rotate(stream)
+
+    def rotate(self, stream):
+        """
+        Close the current file of the stream, write its manifest
+        and announce it with a BATCH message
+        """
+        batch = self.open_files.pop(stream, None)
+        if batch is None:
+            return
+        batch['file'].close()
+        manifest = {
+            "stream": stream,
+            "path": batch['path'],
+            "records": batch['records'],
+            "bytes": os.path.getsize(batch['path']),
+            "created_at": batch['created_at'],
+        }
+        with open(batch['path'] + '.manifest.json', 'w') as file:
+            json.dump(manifest, file)
+        singer.write_message(
+            BatchMessage(stream, ["file://" + batch['path']]))
+        self._write_state()
+
+    def flush(self):
+        """
+        Rotate the open files of all streams and emit
+        any state still held back
+        """
+        for stream in list(self.open_files):
+            self.rotate(stream)
+        self._write_state()
+
+    def _write_state(self):
+        if self.state is not None:
+            singer.write_state(self.state)
+            self.state = None
+
+    def _open(self, stream):
+        created_at = datetime.datetime.utcnow()
+        self.sequence[stream] = self.sequence.get(stream, 0) + 1
+        filename = "{}-{}-{:05d}.jsonl.gz".format(
+            stream, created_at.strftime("%Y%m%dT%H%M%S"),
+            self.sequence[stream])
+        path = os.path.abspath(os.path.join(self.directory, filename))
+        self.open_files[stream] = {
+            "path": path,
+            "file": gzip.open(path, 'wt'),
+            "records": 0,
+            "created_at": tap_utils.strftime(created_at),
+        }
@@ -0,0 +1,162 @@
+"""Pipelined stream sync
+
+Runs the stages of a stream sync (fetch, decode, transform, emit) on
+separate threads connected by bounded queues. Emit runs on the calling
+thread, so a slow target fills the queues and blocks the stages
+upstream of it.
+"""
+
+import queue
+import threading
+import time
+
+# Put/get timeout in seconds, between checks whether the pipeline stopped
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+def run_serial(source, stages, emit):
+    """
+    Run the stages one item at a time on the calling thread
+
+    Arguments:
+        source {[iterable]} -- [Items produced by the fetch stage]
+        stages {[list]} -- [(name, fn) pairs, fn maps an item to an iterable of items]
+        emit {[function]} -- [Called with every item out of the last stage]
+    """
+    for item in source:
+        _run_stages(item, stages, emit)
+
+
+def _run_stages(item, stages, emit):
+    if not stages:
+        emit(item)
+        return
+    for output in stages[0][1](item):
+        _run_stages(output, stages[1:], emit)
+
+
+def run_pipeline(source, stages, emit, queue_sizes):
+    """
+    Run the fetch stage and every stage on its own thread, emit on the
+    calling thread, and return queue depth and stage utilization stats
+
+    Arguments:
+        source {[iterable]} -- [Items produced by the fetch stage]
+        stages {[list]} -- [(name, fn) pairs, fn maps an item to an iterable of items]
+        emit {[function]} -- [Called with every item out of the last stage]
+        queue_sizes {[list]} -- [Bound of the queue in front of each stage and emit]
+    """
+    names = ['fetch'] + [name for name, _ in stages] + ['emit']
+    queues = [queue.Queue(maxsize=size) for size in queue_sizes]
+    stop = threading.Event()
+    errors = []
+    stage_stats = {name: {'items': 0, 'busy': 0.0} for name in names}
+    queue_stats = [{'size': size, 'max_depth': 0, 'depth_total': 0,
+                    'puts': 0} for size in queue_sizes]
+
+    def put(index, item):
+        depth = queues[index].qsize()
+        stats = queue_stats[index]
+        stats['max_depth'] = max(stats['max_depth'], depth)
+        stats['depth_total'] += depth
+        stats['puts'] += 1
+        while not stop.is_set():
+            try:
+                queues[index].put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(index):
+        while not stop.is_set():
+            try:
+                return queues[index].get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def fetch():
+        stats = stage_stats['fetch']
+        try:
+            items = iter(source)
+            while True:
+                started = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                stats['busy'] += time.time() - started
+                stats['items'] += 1
+                if not put(0, item):
+                    return
+        except Exception as exc:
+            errors.append(exc)
+            stop.set()
+        put(0, _DONE)
+
+    def stage(index, name, fn):
+        stats = stage_stats[name]
+        try:
+            while True:
+                item = get(index - 1)
+                if item is _DONE:
+                    break
+                started = time.time()
+                outputs = list(fn(item))
+                stats['busy'] += time.time() - started
+                stats['items'] += 1
+                for output in outputs:
+                    if not put(index, output):
+                        return
+        except Exception as exc:
+            errors.append(exc)
+            stop.set()
+        put(index, _DONE)
+
+    threads = [threading.Thread(target=fetch)]
+    for index, (name, fn) in enumerate(stages):
+        threads.append(threading.Thread(target=stage,
+                                        args=(index + 1, name, fn)))
+    started = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    stats = stage_stats['emit']
+    try:
+        while True:
+            item = get(len(stages))
+            if item is _DONE:
+                break
+            emit_started = time.time()
+            emit(item)
+            stats['busy'] += time.time() - emit_started
+            stats['items'] += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    wall = time.time() - started
+    for stats in stage_stats.values():
+        stats['utilization'] = round(stats['busy'] / wall, 3) if wall else 0.0
+        stats['busy'] = round(stats['busy'], 3)
+    return {
+        'wall_time': round(wall, 3),
+        'stages': stage_stats,
+        'queues': {
+            names[index] + '->' + names[index + 1]: {
+                'size': stats['size'],
+                'max_depth': stats['max_depth'],
+                'mean_depth': round(
+                    stats['depth_total'] / float(stats['puts']), 2)
+                if stats['puts'] else 0.0,
+            } for index, stats in enumerate(queue_stats)
+        },
+    }
@@ -1,5 +1,7 @@
 import collections
+import contextlib
 import datetime
+import fcntl
 import functools
 import json
 import os
@@ -60,6 +62,53 @@ def ratelimit(limit, every):
     return limitdecorator
 
 
+@contextlib.contextmanager
+def locked_bucket(path, limit, every):
+    """
+    Open a token bucket shared through a file under an exclusive lock,
+    yield its refilled state and write back the changes made to it
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        now = time.time()
+        raw = f.read()
+        bucket = json.loads(raw) if raw else {'tokens': limit, 'at': now}
+        elapsed = max(0, now - bucket['at'])
+        bucket['tokens'] = min(
+            limit, bucket['tokens'] + elapsed * limit / float(every))
+        bucket['at'] = now
+        yield bucket
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(bucket))
+
+
+def acquire_token(path, limit, every):
+    """
+    Take a token from a bucket of limit tokens per every seconds,
+    shared by all processes using the same file, sleep until
+    a token is available
+    """
+    while True:
+        with locked_bucket(path, limit, every) as bucket:
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return
+            wait = (1 - bucket['tokens']) * every / float(limit)
+        time.sleep(wait)
+
+
+def drain_tokens(path, limit, every, seconds):
+    """
+    Empty a shared bucket so that no process gets a token
+    for the given number of seconds
+    """
+    with locked_bucket(path, limit, every) as bucket:
+        bucket['tokens'] = min(bucket['tokens'],
+                               1 - seconds * limit / float(every))
+
+
 def chunk(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
@@ -2,15 +2,30 @@
 and check output from stdout via singer.io API calls
 """
 
+import gzip
 import json
+import multiprocessing
 import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import responses
 import pytest
+import requests
+from requests.exceptions import HTTPError
+import tap_freshsales
 from tap_freshsales import discover, sync_contacts_by_filter, owners
 from tap_freshsales import sync_accounts_by_filter, sync_appointments_by_filter
 from tap_freshsales import sync_deals_by_filter, sync_leads_by_filter
 from tap_freshsales import sync_sales_activities, sync_tasks_by_filter
 from tap_freshsales import load_schemas, get_start
+from tap_freshsales import get_deselected_fields, get_schema, get_view_query
+from tap_freshsales import fetch, plan_sync, select_fields, sync
+from tap_freshsales import get_per_page, tune_per_page, flatten_custom_fields
+from tap_freshsales import iter_pages, page_length
+from tap_freshsales import pipeline
+from tap_freshsales.archive import ResponseArchive
+from tap_freshsales.batch import BatchWriter
 
 
 def test_get_start():
@@ -88,3 +103,372 @@ def test_tap_discover():
         assert stream['metadata']
         print(stream['metadata'])
         assert not ('selected' in stream['metadata'][0])
+
+
+def test_batch_writer(tmpdir, capsys):
+    """
+    Test records are rotated into compressed files announced by BATCH messages
+    """
+    writer = BatchWriter(str(tmpdir), batch_size=2)
+    for i in range(3):
+        writer.write('deals', {'id': i})
+    writer.flush()
+    messages = [json.loads(line)
+                for line in capsys.readouterr().out.splitlines()]
+    assert [m['type'] for m in messages] == ['BATCH', 'BATCH']
+    path = messages[0]['manifest'][0].replace('file://', '')
+    with gzip.open(path, 'rt') as file:
+        assert [json.loads(line)['id'] for line in file] == [0, 1]
+    manifest = json.load(open(messages[1]['manifest'][0].replace(
+        'file://', '') + '.manifest.json'))
+    assert manifest['records'] == 1
+
+
+def test_field_selection():
+    """
+    Test deselected fields are pruned from schema, rows and side-loads
+    """
+    catalog = discover()
+    for stream in catalog['streams']:
+        if stream['tap_stream_id'] == 'deals':
+            for mdata in stream['metadata']:
+                if mdata['breadcrumb'] == ['properties', 'name']:
+                    mdata['metadata']['selected'] = False
+    tap_freshsales.DESELECTED_FIELDS = get_deselected_fields(catalog)
+    tap_freshsales.SELECTED_STREAMS = ['deals']
+    try:
+        assert tap_freshsales.DESELECTED_FIELDS == {'deals': {'name'}}
+        assert 'name' not in get_schema('deals')['properties']
+        assert select_fields('deals', {'id': 1, 'name': 'x'}) == {'id': 1}
+        assert get_view_query(1, ['owner']) == 'view/1'
+        tap_freshsales.SELECTED_STREAMS = ['deals', 'owners']
+        assert get_view_query(1, ['owner']) == 'view/1?include=owner'
+    finally:
+        tap_freshsales.DESELECTED_FIELDS = {}
+        tap_freshsales.SELECTED_STREAMS = []
+
+
+def test_pipeline():
+    """
+    Test pipelined stages emit the same records as a serial run,
+    report stats and surface errors raised on stage threads
+    """
+    stages = [('decode', lambda page: page['rows']),
+              ('transform', lambda row: [row * 2] if row % 2 else [])]
+    pages = [{'rows': [1, 2, 3]}, {'rows': [4, 5]}]
+    serial = []
+    pipeline.run_serial(pages, stages, serial.append)
+    piped = []
+    stats = pipeline.run_pipeline(pages, stages, piped.append, [1, 2, 2])
+    assert piped == serial == [2, 6, 10]
+    assert stats['stages']['decode']['items'] == 2
+    assert stats['queues']['transform->emit']['size'] == 2
+
+    def fail(row):
+        raise ValueError(row)
+
+    with pytest.raises(ValueError):
+        pipeline.run_pipeline(pages, [('transform', fail)], piped.append,
+                              [1, 1])
+
+
+@responses.activate
+def test_plan_sync():
+    """
+    Test request estimates from probes and scheduling within the budget
+    """
+    deal_url = 'https://{}.freshsales.io/api/deals/'.format(pytest.TEST_DOMAIN)
+    responses.add(responses.GET, deal_url + 'filters',
+                  json={'filters': [{'id': 1}, {'id': 2}]}, status=200)
+    responses.add(responses.GET, deal_url + 'view/1',
+                  json={'deals': [{}], 'meta': {'total_pages': 250, 'total': 250}},
+                  status=200)
+    responses.add(responses.GET, deal_url + 'view/2',
+                  json={'deals': [{}], 'meta': {'total_pages': 1, 'total': 1}},
+                  status=200)
+    try:
+        plan = plan_sync({'request_budget': 5,
+                          'stream_priorities': {'deals': 2}},
+                         ['owners', 'deals'])
+    finally:
+        tap_freshsales.FILTERS.clear()
+    assert len(responses.calls) == 3
+    assert [entry['stream'] for entry in plan] == ['deals', 'owners']
+    assert plan[0]['views'] == {'1': 3, '2': 1}
+    # 2 requests left after probing, deals get them for a partial sync
+    assert plan[0]['allotted_requests'] == 2
+    assert plan[0]['scheduled']
+    assert plan[1]['scheduled']
+
+
+@responses.activate
+def test_sync_request_budget(monkeypatch):
+    """
+    Test listings stop once the request budget is used up,
+    and a false dry_run does not plan the sync
+    """
+    deal_url = 'https://{}.freshsales.io/api/deals/'.format(pytest.TEST_DOMAIN)
+    responses.add(responses.GET, deal_url + 'filters',
+                  json={'filters': [{'id': 1}]}, status=200)
+    responses.add(responses.GET, deal_url + 'view/1',
+                  json={'deals': [{'id': 1, 'updated_at': '2000-01-01'}] * 100,
+                        'meta': {'total_pages': 1000, 'total': 1000}},
+                  status=200)
+    catalog = {'streams': [{
+        'tap_stream_id': 'deals', 'schema': get_schema('deals'),
+        'metadata': [{'breadcrumb': [], 'metadata': {'selected': True}}]}]}
+    try:
+        sync({'request_budget': 3}, {}, catalog)
+        # Filters and probe leave a single request for the 10 deal pages
+        assert len(responses.calls) == 3
+        assert tap_freshsales.REQUEST_LIMIT is None
+
+        def plan_sync(config, selected_streams):
+            raise AssertionError("Sync was planned")
+        monkeypatch.setattr(tap_freshsales, 'plan_sync', plan_sync)
+        sync({'dry_run': False}, {}, {'streams': []})
+    finally:
+        tap_freshsales.FILTERS.clear()
+        tap_freshsales.TRUNCATED_LISTINGS.clear()
+
+
+@responses.activate
+def test_record_and_replay(tmpdir):
+    """
+    Test recorded responses are replayed without network access
+    """
+    owner_data = json.load(
+        open(os.path.join(pytest.TEST_DIR, 'mock_data/owners.json')))
+    url = 'https://{}.freshsales.io/api/sales_activities/'.format(
+        pytest.TEST_DOMAIN)
+    responses.add(responses.GET, url, json=owner_data, status=200)
+    path = str(tmpdir.join('responses.db'))
+    tap_freshsales.ARCHIVE = ResponseArchive(path, 'record')
+    try:
+        recorded = fetch(url, {'page': 1}).json()
+        tap_freshsales.ARCHIVE.close()
+        tap_freshsales.ARCHIVE = ResponseArchive(path, 'replay')
+        assert fetch(url, {'page': 1}).json() == recorded
+        assert len(responses.calls) == 1
+        with pytest.raises(HTTPError):
+            fetch(url, {'page': 2})
+    finally:
+        tap_freshsales.ARCHIVE.close()
+        tap_freshsales.ARCHIVE = None
+
+
+def _request_owners(url, bucket_dir):
+    """
+    Request owners twice from a tap process sharing the rate limit
+    """
+    tap_freshsales.CONFIG['domain'] = 'testdomain'
+    tap_freshsales.CONFIG['shared_rate_limit_dir'] = bucket_dir
+    tap_freshsales.CONFIG['shared_rate_limit'] = {'limit': 1, 'every': 0.5}
+    for _ in range(2):
+        tap_freshsales.request(url)
+
+
+def test_shared_rate_limit(tmpdir):
+    """
+    Test tap processes on the same account draw from one rate limit,
+    requests go to a local server serving mock owners
+    """
+    arrivals = []
+    owner_data = open(os.path.join(
+        pytest.TEST_DIR, 'mock_data/owners.json'), 'rb').read()
+
+    class OwnersHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            arrivals.append(time.time())
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(owner_data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), OwnersHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:{}/api/owners'.format(server.server_port)
+    try:
+        processes = [multiprocessing.Process(
+            target=_request_owners, args=(url, str(tmpdir)))
+            for _ in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    assert len(arrivals) == 6
+    arrivals.sort()
+    gaps = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+    # One request per half second across all processes
+    assert min(gaps) > 0.4
+
+
+def test_adaptive_page_size():
+    """
+    Test page sizes shrink after slow pages, grow after fast ones
+    and are kept in state for the next listing
+    """
+    tap_freshsales.CONFIG['adaptive_page_size'] = True
+    tap_freshsales.CONFIG['page_size_range'] = [25, 200]
+    try:
+        assert get_per_page('leads') == 100
+        tune_per_page('leads', 100, [(0.5, 2, 1.0), (8, 2, 1.0)])
+        assert get_per_page('leads') == 50
+        tune_per_page('leads', 50, [(0.5, 2, 1.0), (1, 2, 1.0)])
+        tune_per_page('owners', 200, [(0.5, 2, 1.0)])
+        assert tap_freshsales.STATE['per_page'] == {'leads': 100,
+                                                    'owners': 200}
+    finally:
+        del tap_freshsales.CONFIG['adaptive_page_size']
+        del tap_freshsales.CONFIG['page_size_range']
+        tap_freshsales.STATE.pop('per_page', None)
+    assert get_per_page('leads') == 100
+
+
+@responses.activate
+def test_adaptive_page_size_ignores_last_page():
+    """
+    Test the page size is tuned once per listing, from its full pages
+    """
+    url = 'https://{}.freshsales.io/api/leads/view/1'.format(
+        pytest.TEST_DOMAIN)
+    lead = {'id': 1, 'display_name': 'x' * 100}
+    responses.add(responses.GET, url, json={'leads': [lead] * 100},
+                  status=200)
+    responses.add(responses.GET, url, json={'leads': [lead]}, status=200)
+    tap_freshsales.CONFIG['adaptive_page_size'] = True
+    tap_freshsales.CONFIG['max_page_bytes'] = 5000
+    try:
+        for data in iter_pages(url, endpoint='leads'):
+            assert get_per_page('leads') == 100
+        # The full page is over max_page_bytes, the short one well under
+        assert get_per_page('leads') == 50
+    finally:
+        del tap_freshsales.CONFIG['adaptive_page_size']
+        del tap_freshsales.CONFIG['max_page_bytes']
+        tap_freshsales.STATE.pop('per_page', None)
+
+
+@responses.activate
+def test_typed_custom_fields():
+    """
+    Test custom fields are discovered as typed columns and
+    records are flattened into them
+    """
+    fields_url = 'https://{}.freshsales.io/api/settings/deals/fields'.format(
+        pytest.TEST_DOMAIN)
+    responses.add(responses.GET, fields_url, json={'fields': [
+        {'name': 'name', 'type': 'text'},
+        {'name': 'cf_rate', 'type': 'number'},
+        {'name': 'cf_currency', 'type': 'dropdown'},
+        {'name': 'cf_last_loading_day', 'type': 'date'},
+    ]}, status=200)
+    tap_freshsales.CONFIG['typed_custom_fields'] = True
+    tap_freshsales.CUSTOM_FIELDS.update(
+        {'contacts': [], 'leads': [], 'accounts': []})
+    try:
+        catalog = discover()
+        deals = [stream for stream in catalog['streams']
+                 if stream['tap_stream_id'] == 'deals'][0]
+        assert deals['schema']['properties']['custom_field[cf_rate]'] == \
+            {'type': ['null', 'number']}
+        assert 'custom_field[name]' not in deals['schema']['properties']
+        tap_freshsales.CATALOG_SCHEMAS = {'deals': deals['schema']}
+        record = flatten_custom_fields('deals', {'id': 1, 'custom_field': {
+            'cf_rate': '2.5', 'cf_currency': 'KES',
+            'cf_last_loading_day': '2019-09-18', 'cf_unknown': 'x'}})
+        assert record == {
+            'id': 1,
+            'custom_field[cf_rate]': 2.5,
+            'custom_field[cf_currency]': 'KES',
+            'custom_field[cf_last_loading_day]': '2019-09-18T00:00:00Z',
+        }
+    finally:
+        del tap_freshsales.CONFIG['typed_custom_fields']
+        tap_freshsales.CUSTOM_FIELDS.clear()
+        tap_freshsales.CUSTOM_FIELD_TYPES.clear()
+        tap_freshsales.CATALOG_SCHEMAS = {}
+    assert len(responses.calls) == 1
+
+
+@pytest.mark.parametrize('selected_streams, include', [
+    (['accounts'], None),
+    (['accounts', 'owners'], 'owner'),
+])
+@responses.activate
+def test_sync_accounts_by_filter(capsys, selected_streams, include):
+    """
+    Test sync of accounts with and without the owner side-load
+    """
+    account_data = json.load(
+        open(os.path.join(pytest.TEST_DIR, 'mock_data/sales_accounts.json')))
+    account_url = 'https://{}.freshsales.io/api/sales_accounts/view/5000440490'.format(
+        pytest.TEST_DOMAIN)
+    responses.add(responses.GET, account_url,
+                  json=account_data, status=200, content_type='application/json')
+    tap_freshsales.SELECTED_STREAMS = selected_streams
+    tap_freshsales.STATE['accounts_5000440490'] = '2000-01-01T00:00:00Z'
+    try:
+        assert sync_accounts_by_filter('updated_at', {'id': 5000440490}) is None
+    finally:
+        tap_freshsales.SELECTED_STREAMS = []
+        del tap_freshsales.STATE['accounts_5000440490']
+    assert len(responses.calls) == 1
+    assert responses.calls[0].request.params.get('include') == include
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record['type'] for record in records] == ['RECORD']
+    assert records[0]['stream'] == 'accounts'
+
+
+@responses.activate
+def test_iter_pages_pagination():
+    """
+    Test accounts are paged on their rows, not the side-loaded users
+    """
+    account_url = 'https://{}.freshsales.io/api/sales_accounts/view/1'.format(
+        pytest.TEST_DOMAIN)
+    owner_data = json.load(
+        open(os.path.join(pytest.TEST_DIR, 'mock_data/owners.json')))
+    full_page = {'users': owner_data['users'],
+                 'sales_accounts': [{'id': i} for i in range(100)]}
+    responses.add(responses.GET, account_url, json=full_page, status=200)
+    responses.add(responses.GET, account_url,
+                  json={'sales_accounts': [{'id': 100}]}, status=200)
+    pages = list(iter_pages(account_url, endpoint='accounts'))
+    assert len(responses.calls) == 2
+    assert [page_length(page, 'accounts') for page in pages] == [100, 1]
+
+
+@responses.activate
+def test_sync_contacts_in_batch_mode(tmpdir, capsys):
+    """
+    Test contacts of a view share one batch file, announced with
+    the state covering them
+    """
+    contact_data = json.load(
+        open(os.path.join(pytest.TEST_DIR, 'mock_data/contacts.json')))
+    contact_url = 'https://{}.freshsales.io/api/contacts/view/5000440489'.format(
+        pytest.TEST_DOMAIN)
+    responses.add(responses.GET, contact_url,
+                  json=contact_data, status=200, content_type='application/json')
+    tap_freshsales.BATCH_WRITER = BatchWriter(str(tmpdir))
+    tap_freshsales.STATE['contacts_5000440489'] = '2000-01-01T00:00:00Z'
+    try:
+        sync_contacts_by_filter('updated_at', {'id': 5000440489})
+    finally:
+        tap_freshsales.BATCH_WRITER = None
+        del tap_freshsales.STATE['contacts_5000440489']
+    messages = [json.loads(line)
+                for line in capsys.readouterr().out.splitlines()]
+    assert [m['type'] for m in messages] == ['BATCH', 'STATE']
+    assert messages[1]['value']['contacts_5000440489'] == max(
+        contact['updated_at'] for contact in contact_data['contacts'])
+    assert len(tmpdir.listdir()) == 2